@@ -1,26 +1,154 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from typing import Tuple
+from typing import Any, Dict, Tuple
 
 from config import Config, load_pkl, pkl_parser
 from env import Env_tsp
 
 
-class Greedy(nn.Module):
-    def __init__(self) -> None:
-        super().__init__()
+@torch.jit.script
+def glimpse(
+    u1: torch.Tensor,
+    u2: torch.Tensor,
+    u2_next: torch.Tensor,
+    visited: torch.Tensor,
+    Vec: torch.Tensor,
+    softmax_T: float,
+    inf: float = 1e8,
+) -> torch.Tensor:
+    """-ref about torch.bmm, torch.matmul and so on
+    https://qiita.com/tand826/items/9e1b6a4de785097fe6a5
+    https://qiita.com/shinochin/items/aa420e50d847453cc296
 
-    def forward(self, log_p: torch.Tensor) -> torch.Tensor:
-        return torch.argmax(log_p, dim=1).long()
+            Args:
+    u1: W_q projection of the hidden state of the decoder at the current
+    (batch, 128)
+    u2: W_ref projection of the set of hidden states from the encoder, computed once per forward
+    (batch, city_t, 128)
+    u2_next: u2 projected by the weight (no bias) of the layer that takes this glimpse as query, W_q or W_q2
+    (batch, city_t, 128)
+    visited: model only points at cities that have yet to be visited, so prevent them from being reselected
+    (batch, t), indices of the cities selected so far
+    return: glimpse already projected by that weight, W(a @ u2) - bias = a @ u2_next
+    (batch, 128)
+    """
+    u = torch.matmul(torch.tanh(u1.unsqueeze(1) + u2), Vec)
+    # u1+u2: (batch, city_t, 128) * V: (128), one (batch*city_t, 128) matvec => u: (batch, city_t)
+    u.scatter_(1, visited, -inf)
+    a = F.softmax(u / softmax_T, dim=1)
+    d = torch.bmm(a.unsqueeze(1), u2_next).squeeze(1)
+    # a: (batch, 1, city_t) * u2_next: (batch, city_t, 128) => d: (batch, 128)
+    return d
 
 
-class Categorical(nn.Module):
-    def __init__(self) -> None:
-        super().__init__()
+@torch.jit.script
+def pointer(
+    u1: torch.Tensor,
+    u2: torch.Tensor,
+    visited: torch.Tensor,
+    Vec2: torch.Tensor,
+    clip_logits: float,
+    inf: float = 1e8,
+) -> torch.Tensor:
+    """Args:
+    u1: W_q2 projection of the query
+    (batch, 128)
+    u2: W_ref2 projection of the set of hidden states from the encoder, computed once per forward
+    (batch, city_t, 128)
+    visited: model only points at cities that have yet to be visited, so prevent them from being reselected
+    (batch, t), indices of the cities selected so far
+    """
+    u = torch.matmul(clip_logits * torch.tanh(u1.unsqueeze(1) + u2), Vec2)
+    # u1+u2: (batch, city_t, 128) * V: (128), one (batch*city_t, 128) matvec => u: (batch, city_t)
+    u.scatter_(1, visited, -inf)
+    return u
+
+
+@torch.jit.script
+def decode_loop(
+    h: torch.Tensor,
+    c: torch.Tensor,
+    embed_enc_inputs: torch.Tensor,
+    u2: torch.Tensor,
+    u2p: torch.Tensor,
+    dec_input: torch.Tensor,
+    w_ih: torch.Tensor,
+    w_hh: torch.Tensor,
+    b_ih: torch.Tensor,
+    b_hh: torch.Tensor,
+    W_q_weight: torch.Tensor,
+    W_q_bias: torch.Tensor,
+    W_q2_weight: torch.Tensor,
+    W_q2_bias: torch.Tensor,
+    Vec: torch.Tensor,
+    Vec2: torch.Tensor,
+    n_glimpse: int,
+    softmax_T: float,
+    clip_logits: float,
+    greedy: bool,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """scripted so that the per-step ops skip python dispatch
+    h, c: (batch, hidden), encoder final state
+    embed_enc_inputs: (batch, city_t, embed)
+    u2, u2p: (batch, city_t, hidden), W_ref and W_ref2 projections of encoder outputs
+    dec_input: (batch, embed)
+    w_ih, w_hh, b_ih, b_hh: weights of the single layer decoder LSTM
+    return: pi: (batch, city_t), ll: (batch)
+    """
+    batch, city_t, embed = embed_enc_inputs.size()
+    device = embed_enc_inputs.device
+    visited = torch.empty((batch, 0), dtype=torch.long, device=device)
+    ll = torch.zeros(batch, dtype=embed_enc_inputs.dtype, device=device)
+    # a glimpse a @ u2 is only ever fed to W_q (next glimpse) or W_q2 (pointer),
+    # so fold those weights into u2 once: W(a @ u2) = a @ (u2 W^T) + b
+    u2_q = F.linear(u2, W_q_weight) if n_glimpse > 1 else u2
+    u2_q2 = F.linear(u2, W_q2_weight) if n_glimpse > 0 else u2
+    for _ in range(city_t):
+        h, c = torch.lstm_cell(dec_input, [h, c], w_ih, w_hh, b_ih, b_hh)
+        if n_glimpse > 0:
+            u1 = F.linear(h, W_q_weight, W_q_bias)
+        else:
+            u1 = F.linear(h, W_q2_weight, W_q2_bias)
+        for i in range(n_glimpse):
+            if i < n_glimpse - 1:
+                u1 = glimpse(u1, u2, u2_q, visited, Vec, softmax_T) + W_q_bias
+            else:
+                u1 = glimpse(u1, u2, u2_q2, visited, Vec, softmax_T) + W_q2_bias
+        logits = pointer(u1, u2p, visited, Vec2, clip_logits)
+        if greedy:
+            # argmax(log_softmax(logits)) == argmax(logits), only the picked log_p is needed
+            next_node = torch.argmax(logits, dim=1)  # (batch,)
+            picked = logits.gather(1, next_node.unsqueeze(1)).squeeze(1)
+            step_ll = picked - torch.logsumexp(logits, dim=1)  # (batch,)
+        else:
+            log_p = torch.log_softmax(logits, dim=-1)  # (batch, city_t)
+            next_node = torch.multinomial(log_p.exp(), 1).squeeze(1)  # (batch,)
+            step_ll = log_p.gather(1, next_node.unsqueeze(1)).squeeze(1)
+        dec_input = torch.gather(
+            input=embed_enc_inputs,
+            dim=1,
+            index=next_node.view(-1, 1, 1).expand(-1, 1, embed),  # (batch, 1, embed)
+        ).squeeze(1)  # (batch, embed)
 
-    def forward(self, log_p: torch.Tensor) -> torch.Tensor:
-        return torch.multinomial(log_p.exp(), 1).long().squeeze(1)
+        ll = ll + step_ll
+        # not in-place: scatter_ in glimpse/pointer saved the previous visited for backward
+        visited = torch.cat([visited, next_node.unsqueeze(1)], dim=1)
+
+    # every city is visited once, in order, so visited is the tour
+    return visited, ll
+
+
+def squeeze_conv1d_w_ref(
+    state_dict: Dict[str, torch.Tensor], prefix: str, *args: Any
+) -> None:
+    '''load_state_dict pre-hook of PtrNet1
+    W_ref and W_ref2 used to be Conv1d(hidden, hidden, 1, 1), their weights carry a kernel dim
+    '''
+    for name in ['W_ref', 'W_ref2']:
+        key = prefix + name + '.weight'
+        if key in state_dict and state_dict[key].dim() == 3:
+            state_dict[key] = state_dict[key].squeeze(-1)
 
 
 # https://github.com/higgsfield/np-hard-deep-reinforcement-learning/blob/master/Neural%20Combinatorial%20Optimization.ipynb
@@ -41,17 +169,16 @@ class PtrNet1(nn.Module):
         self.Vec = nn.Parameter(torch.FloatTensor(cfg.embed))
         self.Vec2 = nn.Parameter(torch.FloatTensor(cfg.embed))
         self.W_q = nn.Linear(cfg.hidden, cfg.hidden, bias=True)
-        self.W_ref = nn.Conv1d(cfg.hidden, cfg.hidden, 1, 1)
+        self.W_ref = nn.Linear(cfg.hidden, cfg.hidden, bias=True)
         self.W_q2 = nn.Linear(cfg.hidden, cfg.hidden, bias=True)
-        self.W_ref2 = nn.Conv1d(cfg.hidden, cfg.hidden, 1, 1)
+        self.W_ref2 = nn.Linear(cfg.hidden, cfg.hidden, bias=True)
         self.dec_input = nn.Parameter(torch.FloatTensor(cfg.embed))
         self._initialize_weights(cfg.init_min, cfg.init_max)
         self.clip_logits = cfg.clip_logits
         self.softmax_T = cfg.softmax_T
         self.n_glimpse = cfg.n_glimpse
-        self.city_selecter = {'greedy': Greedy(), 'sampling': Categorical()}[
-            cfg.decode_type
-        ]
+        self.decode_type = cfg.decode_type  # 'greedy' or 'sampling'
+        self._register_load_state_dict_pre_hook(squeeze_conv1d_w_ref)
 
     def _initialize_weights(
         self, init_min: float = -0.08, init_max: float = 0.08
@@ -59,128 +186,75 @@ class PtrNet1(nn.Module):
         for param in self.parameters():
             nn.init.uniform_(param.data, init_min, init_max)
 
-    def forward(
-        self, x: torch.Tensor, device: str
-    ) -> Tuple[torch.Tensor, torch.Tensor]:
-        '''x: (batch, city_t, 2)
+    def forward(self, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        '''x: (batch, city_t, 2), on the same device as the model
         enc_h: (batch, city_t, embed)
-        dec_input: (batch, 1, embed)
+        dec_input: (batch, embed)
         h: (1, batch, embed)
         return: pi: (batch, city_t), ll: (batch)
         '''
-        x = x.to(device)
-        batch, city_t, _ = x.size()
+        # no-op when the cuDNN weight buffer is still packed
+        self.Encoder.flatten_parameters()
+        # encoder side in bf16 on GPUs that support it, the decoding loop stays in fp32
+        # torch.autocast needs torch>=1.10, older versions run the encoder in fp32
+        use_bf16 = (
+            x.is_cuda
+            and hasattr(torch, 'autocast')
+            and torch.cuda.is_bf16_supported()
+        )
+        if use_bf16:
+            with torch.autocast('cuda', dtype=torch.bfloat16):
+                h, c, embed_enc_inputs, u2, u2p = self._encode(x)
+            h, c = h.float(), c.float()
+            embed_enc_inputs, u2, u2p = embed_enc_inputs.float(), u2.float(), u2p.float()
+        else:
+            h, c, embed_enc_inputs, u2, u2p = self._encode(x)
+        dec_input = self.dec_input.view(1, -1).expand(x.size(0), -1)  # (batch, embed)
+        pi, ll = decode_loop(
+            h.squeeze(0),
+            c.squeeze(0),
+            embed_enc_inputs,
+            u2,
+            u2p,
+            dec_input,
+            self.Decoder.weight_ih_l0,
+            self.Decoder.weight_hh_l0,
+            self.Decoder.bias_ih_l0,
+            self.Decoder.bias_hh_l0,
+            self.W_q.weight,
+            self.W_q.bias,
+            self.W_q2.weight,
+            self.W_q2.bias,
+            self.Vec,
+            self.Vec2,
+            self.n_glimpse,
+            float(self.softmax_T),
+            float(self.clip_logits),
+            self.decode_type == 'greedy',
+        )  # pi: (batch, city_t), ll: (batch,)
+        return pi, ll
+
+    def _encode(
+        self, x: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        '''x: (batch, city_t, 2)
+        return: h, c: (1, batch, hidden), embed_enc_inputs: (batch, city_t, embed),
+        u2, u2p: (batch, city_t, hidden)
+        '''
         embed_enc_inputs = self.Embedding(x)  # (batch, city_t, embed)
-        embed = embed_enc_inputs.size(2)
-        mask = torch.zeros((batch, city_t), device=device)
         enc_h, (h, c) = self.Encoder(embed_enc_inputs, None)
         ref = enc_h
-        pi_list, log_ps = [], []
-        dec_input = (
-            self.dec_input.unsqueeze(0).repeat(batch, 1).unsqueeze(1).to(device)
-        )  # (batch, 1, embed)
-        for _ in range(city_t):
-            _, (h, c) = self.Decoder(dec_input, (h, c))
-            query = h.squeeze(0)
-            for _ in range(self.n_glimpse):
-                query = self.glimpse(query, ref, mask)
-            logits = self.pointer(query, ref, mask)
-            log_p = torch.log_softmax(logits, dim=-1)  # (batch, city_t)
-            next_node = self.city_selecter(log_p)  # (batch,)
-            dec_input = torch.gather(
-                input=embed_enc_inputs,
-                dim=1,
-                index=next_node.unsqueeze(-1)
-                .unsqueeze(-1)
-                .repeat(1, 1, embed),  # (batch, 1, embed)
-            )  # (batch, 1, embed)
-
-            pi_list.append(next_node)
-            log_ps.append(log_p)
-            mask += torch.zeros((batch, city_t), device=device).scatter_(
-                dim=1, index=next_node.unsqueeze(1), value=1
-            )  # index: (batch, 1)
-
-        pi = torch.stack(pi_list, dim=1)  # (batch, city_t)
-        ll = self.get_log_likelihood(torch.stack(log_ps, 1), pi)  # (batch,)
-        return pi, ll
-
-    def glimpse(
-        self,
-        query: torch.Tensor,
-        ref: torch.Tensor,
-        mask: torch.Tensor,
-        inf: float = 1e8,
-    ) -> torch.Tensor:
-        """-ref about torch.bmm, torch.matmul and so on
-        https://qiita.com/tand826/items/9e1b6a4de785097fe6a5
-        https://qiita.com/shinochin/items/aa420e50d847453cc296
-
-                Args:
-        query: the hidden state of the decoder at the current
-        (batch, 128)
-        ref: the set of hidden states from the encoder.
-        (batch, city_t, 128)
-        mask: model only points at cities that have yet to be visited, so prevent them from being reselected
-        (batch, city_t)
-        """
-        u1 = (
-            self.W_q(query).unsqueeze(-1).repeat(1, 1, ref.size(1))
-        )  # u1: (batch, 128, city_t)
-        u2 = self.W_ref(ref.permute(0, 2, 1))  # u2: (batch, 128, city_t)
-        V = self.Vec.unsqueeze(0).unsqueeze(0).repeat(ref.size(0), 1, 1)
-        u = torch.bmm(V, torch.tanh(u1 + u2)).squeeze(1)
-        # V: (batch, 1, 128) * u1+u2: (batch, 128, city_t) => u: (batch, 1, city_t) => (batch, city_t)
-        u = u - inf * mask
-        a = F.softmax(u / self.softmax_T, dim=1)
-        d = torch.bmm(u2, a.unsqueeze(2)).squeeze(2)
-        # u2: (batch, 128, city_t) * a: (batch, city_t, 1) => d: (batch, 128)
-        return d
-
-    def pointer(
-        self,
-        query: torch.Tensor,
-        ref: torch.Tensor,
-        mask: torch.Tensor,
-        inf: float = 1e8,
-    ) -> torch.Tensor:
-        """Args:
-        query: the hidden state of the decoder at the current
-        (batch, 128)
-        ref: the set of hidden states from the encoder.
-        (batch, city_t, 128)
-        mask: model only points at cities that have yet to be visited, so prevent them from being reselected
-        (batch, city_t)
-        """
-        u1 = (
-            self.W_q2(query).unsqueeze(-1).repeat(1, 1, ref.size(1))
-        )  # u1: (batch, 128, city_t)
-        u2 = self.W_ref2(ref.permute(0, 2, 1))  # u2: (batch, 128, city_t)
-        V = self.Vec2.unsqueeze(0).unsqueeze(0).repeat(ref.size(0), 1, 1)
-        u = torch.bmm(V, self.clip_logits * torch.tanh(u1 + u2)).squeeze(1)
-        # V: (batch, 1, 128) * u1+u2: (batch, 128, city_t) => u: (batch, 1, city_t) => (batch, city_t)
-        u = u - inf * mask
-        return u
-
-    def get_log_likelihood(
-        self, _log_p: torch.Tensor, pi: torch.Tensor
-    ) -> torch.Tensor:
-        """args:
-        _log_p: (batch, city_t, city_t) # arg1 is step
-        pi: (batch, city_t), predicted tour
-        return: (batch)
-        """
-        log_p = torch.gather(
-            input=_log_p, dim=2, index=pi[:, :, None]
-        )  # (batch, city_t, 1)
-        return torch.sum(log_p.squeeze(-1), 1)
+        # ref is constant over decoding, so project it once for all steps
+        u2 = self.W_ref(ref)  # (batch, city_t, hidden)
+        u2p = self.W_ref2(ref)  # (batch, city_t, hidden)
+        return h, c, embed_enc_inputs, u2, u2p
 
 
 if __name__ == '__main__':
     cfg = load_pkl(pkl_parser().path)
     model = PtrNet1(cfg).cuda()
-    inputs = torch.randn(3, 20, 2)
-    pi, ll = model(inputs, device='cuda:0')
+    inputs = torch.randn(3, 20, 2).cuda()
+    pi, ll = model(inputs)
     print('pi:', pi.size(), pi, sep='\n')
     print('log_likelihood:', ll.size(), ll)
 
@@ -195,7 +269,5 @@ if __name__ == '__main__':
 
     cfg.batch = 3
     env = Env_tsp(cfg)
-    cost = env.stack_l(inputs, pi)
-    print('cost:', cost.size(), cost)
-    cost = env.stack_l_fast(inputs, pi.cpu())
+    cost = env.stack_l_fast(inputs, pi)
     print('cost:', cost.size(), cost)
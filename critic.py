@@ -37,14 +37,13 @@ class PtrNet2(nn.Module):
         for param in self.parameters():
             nn.init.uniform_(param.data, init_min, init_max)
 
-    def forward(self, x: torch.Tensor, device: str) -> torch.Tensor:
-        '''x: (batch, city_t, 2)
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        '''x: (batch, city_t, 2), on the same device as the model
         enc_h: (batch, city_t, embed)
         query(Decoder input): (batch, 1, embed)
         h: (1, batch, embed)
         return: pred_l: (batch)
         '''
-        x = x.to(device)
         batch, city_t, xy = x.size()
         embed_enc_inputs = self.Embedding(x)  # (batch, city_t, embed)
         embed = embed_enc_inputs.size(2)
@@ -81,13 +80,10 @@ class PtrNet2(nn.Module):
         ref: the set of hidden states from the encoder.
         (batch, city_t, 128)
         """
-        u1 = (
-            self.W_q(query).unsqueeze(-1).repeat(1, 1, ref.size(1))
-        )  # u1: (batch, 128, city_t)
+        u1 = self.W_q(query).unsqueeze(-1)  # u1: (batch, 128, 1)
         u2 = self.W_ref(ref.permute(0, 2, 1))  # u2: (batch, 128, city_t)
-        V = self.Vec.unsqueeze(0).unsqueeze(0).repeat(ref.size(0), 1, 1)
-        u = torch.bmm(V, torch.tanh(u1 + u2)).squeeze(1)
-        # V: (batch, 1, 128) * u1+u2: (batch, 128, city_t) => u: (batch, 1, city_t) => (batch, city_t)
+        u = torch.matmul(self.Vec, torch.tanh(u1 + u2))
+        # V: (128) * u1+u2: (batch, 128, city_t), u1 broadcast over city_t => u: (batch, city_t)
         a = F.softmax(u, dim=1)
         d = torch.bmm(u2, a.unsqueeze(2)).squeeze(2)
         # u2: (batch, 128, city_t) * a: (batch, city_t, 1) => d: (batch, 128)
@@ -97,10 +93,10 @@ class PtrNet2(nn.Module):
 if __name__ == '__main__':
     cfg = load_pkl(pkl_parser().path)
     model = PtrNet2(cfg)
-    inputs = torch.randn(3, 20, 2)
     device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    inputs = torch.randn(3, 20, 2, device=device)
     model = model.to(device)
-    pred_l = model(inputs, device)
+    pred_l = model(inputs)
     print('pred_length:', pred_l.size(), pred_l)
 
     cnt = 0
@@ -11,15 +11,15 @@ from env import Env_tsp
 
 
 def sampling(cfg: Config, env: Env_tsp, test_input: torch.Tensor) -> torch.Tensor:
-    test_inputs = test_input.repeat(cfg.batch, 1, 1)
     device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    test_inputs = test_input.repeat(cfg.batch, 1, 1).to(device)
     act_model = PtrNet1(cfg)
     if os.path.exists(cfg.act_model_path):
         act_model.load_state_dict(torch.load(cfg.act_model_path, map_location=device))
     else:
         print('specify pretrained model path')
     act_model = act_model.to(device)
-    pred_tours, _ = act_model(test_inputs, device)
+    pred_tours, _ = act_model(test_inputs)
     l_batch = env.stack_l_fast(test_inputs, pred_tours)
     index_lmin = torch.argmin(l_batch)
     best_tour = pred_tours[index_lmin]
@@ -57,11 +57,9 @@ def active_search(
         This increases the stochasticity of the sampling procedure and leads to large improvements in Active Search.
         '''
         test_inputs = test_inputs.to(device)
-        shuffle_inputs = env.shuffle(test_inputs)
-        pred_shuffle_tours, neg_log = act_model(shuffle_inputs, device)
-        pred_tours = env.back_tours(
-            pred_shuffle_tours, shuffle_inputs, test_inputs, device
-        ).to(device)
+        shuffle_inputs, perm = env.shuffle(test_inputs)
+        pred_shuffle_tours, neg_log = act_model(shuffle_inputs)
+        pred_tours = env.back_tours(perm, pred_shuffle_tours)
 
         l_batch = env.stack_l_fast(test_inputs, pred_tours)
 
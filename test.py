@@ -46,7 +46,7 @@ if __name__ == '__main__':
 
     # inputs = env.stack_nodes()
     # ~ tours = env.stack_random_tours()
-    # ~ l = env.stack_l(inputs, tours)
+    # ~ l = env.stack_l_fast(inputs, tours)
 
     # ~ nodes = env.get_nodes(cfg.seed)
     # random_tour = env.get_random_tour()
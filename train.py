@@ -57,10 +57,10 @@ def train_model(cfg: Config, env: Env_tsp, log_path: str = None) -> None:
     # for i, inputs in tqdm(enumerate(dataloader)):
     for i, inputs in enumerate(dataloader):
         inputs = inputs.to(device)
-        pred_tour, ll = act_model(inputs, device)
+        pred_tour, ll = act_model(inputs)
         real_l = env.stack_l_fast(inputs, pred_tour)
         if cfg.mode == 'train':
-            pred_l = cri_model(inputs, device)
+            pred_l = cri_model(inputs)
             cri_loss = mse_loss(pred_l, real_l.detach())
             cri_optim.zero_grad()
             cri_loss.backward()